@@ -1,9 +1,14 @@
 """Fall detection pipe element."""
 import logging
 import math
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
 from pathlib import Path
 
+import numpy as np
 from ambianic.configuration import DEFAULT_DATA_DIR
 from ambianic.pipeline.ai.pose_engine import PoseEngine
 from ambianic.pipeline.ai.tf_detect import TFDetectionModel
@@ -11,12 +16,204 @@ from PIL import Image, ImageDraw
 
 log = logging.getLogger(__name__)
 
+try:
+    from numba import njit
+except ImportError:  # pragma: no cover
+    log.debug("numba not available. Fall detection geometry will run in Python.")
+
+    def njit(*args, **kwargs):
+        """No-op stand-in for numba.njit when numba is not installed."""
+
+        def decorator(func):
+            return func
+
+        return decorator
+
+
+# max number of debug images waiting to be saved
+_DEBUG_DUMP_QUEUE_SIZE = 4
+
+# fastmath without the no-NaN/no-Inf assumptions,
+# because missing keypoints are represented as NaN
+_FASTMATH_FLAGS = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+# angle in degrees of the vertical axis with the horizontal axis,
+# same as math.degrees(math.atan2(height, 0)) for any image height
+_Y_AXIS_THETA = 90.0
+
+# RGB color of the body lines drawn on debug thumbnails
+_LINE_COLOR = (255, 0, 0)
+
+
+@njit(cache=True, fastmath=_FASTMATH_FLAGS)
+def _line_theta(kps, line):
+    """Angle in degrees of a shoulder-hip line with the horizontal axis."""
+    # line 0 is KP.LS-KP.LH, line 1 is KP.RS-KP.RH
+    shoulder = 2 * line
+    hip = shoulder + 1
+    return math.degrees(
+        math.atan2(kps[hip, 1] - kps[shoulder, 1], kps[shoulder, 0] - kps[hip, 0])
+    )
+
+
+@njit(cache=True, fastmath=_FASTMATH_FLAGS)
+def _pose_geom(curr_kps, curr_mask, prev_kps_1, prev_mask_1, prev_kps_2, prev_mask_2):
+    """Compute the per frame geometry needed for fall detection.
+
+    :Parameters:
+    ----------
+    curr_kps : numpy.ndarray
+        (4, 2) keypoints of the current frame indexed by KP.
+        NaN coordinates mark undetected keypoints.
+    curr_mask : int
+        Bitmask of the detected current frame keypoints, bit i for KP i.
+    prev_kps_1, prev_mask_1 : numpy.ndarray, int
+        Keypoints and bitmask of the frame at t-1.
+    prev_kps_2, prev_mask_2 : numpy.ndarray, int
+        Keypoints and bitmask of the frame at t-2.
+    :Returns:
+    -------
+    numpy.ndarray
+        (3, 2) array. Row 0 holds the (left, right) shoulder-hip line
+        angles with the vertical axis. Rows 1 and 2 hold the (left, right)
+        changes in angle from the frames at t-1 and t-2.
+        Angles for lines that are not detected are 0.
+    """
+    angles = np.zeros((3, 2))
+    for line in range(2):
+        # shoulder and hip bits of the line
+        line_mask = 3 << (2 * line)
+        if curr_mask & line_mask != line_mask:
+            continue
+        curr_theta = _line_theta(curr_kps, line)
+        angles[0, line] = abs(_Y_AXIS_THETA - curr_theta)
+        if prev_mask_1 & line_mask == line_mask:
+            angles[1, line] = abs(_line_theta(prev_kps_1, line) - curr_theta)
+        if prev_mask_2 & line_mask == line_mask:
+            angles[2, line] = abs(_line_theta(prev_kps_2, line) - curr_theta)
+    return angles
+
+
+def _frame_hash(image):
+    """Return a 64 bit difference hash (dHash) of an image.
+
+    Visually similar images have hashes with a small Hamming distance.
+    """
+    # resampling a full size frame straight down to 9x8 is costly.
+    # shrink it by a whole factor first with a cheap box reduction,
+    # keeping a few pixels per hash pixel for the final resize.
+    factor = min(image.width // (9 * 4), image.height // (8 * 4))
+    if factor > 1 and hasattr(image, "reduce"):
+        # Image.reduce is new in Pillow 7.0
+        image = image.reduce(factor)
+    pixels = np.asarray(
+        image.resize((9, 8), Image.BILINEAR).convert("L"), dtype=np.int16
+    )
+    bits = np.diff(pixels, axis=1) > 0
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+if hasattr(int, "bit_count"):
+
+    def _hamming_distance(hash_1, hash_2):
+        """Return the number of bits that differ b/w two hashes."""
+        return (hash_1 ^ hash_2).bit_count()
+
+else:  # pragma: no cover
+    # int.bit_count is new in Python 3.10
+
+    def _hamming_distance(hash_1, hash_2):
+        """Return the number of bits that differ b/w two hashes."""
+        return bin(hash_1 ^ hash_2).count("1")
+
+
+def _inverse_rotation(k, width, height, scale=(1.0, 1.0)):
+    """Return the matrix and offset that map (x, y) coordinates in an image
+    rotated k times by 90' counter clockwise back to the coordinates in
+    the original width x height image.
+
+    scale holds the (x, y) factors to apply first when the rotated image
+    was also shrunk, such as to fit a non-square model input.
+    """
+    if k == 1:
+        # rotated 90' counter clockwise from ^ to < orientation
+        rotation, offset = np.array([[0, -1], [1, 0]]), np.array([width, 0])
+    else:
+        # k == 3: rotated 90' clockwise from ^ to > orientation
+        rotation, offset = np.array([[0, 1], [-1, 0]]), np.array([0, height])
+    return rotation @ np.diag(scale), offset
+
+
+def _save_jpeg(image, path):
+    """Save an image to a JPEG file."""
+    image.save(path, format="JPEG")
+
+
+class KP(IntEnum):
+    """Index of the fall detection keypoints in a pose keypoint array."""
+
+    LS = 0  # left shoulder
+    LH = 1  # left hip
+    RS = 2  # right shoulder
+    RH = 3  # right hip
+
+
+# keypoint bitmasks of the shoulder-hip lines
+_LEFT_LINE = (1 << KP.LS) | (1 << KP.LH)
+_RIGHT_LINE = (1 << KP.RS) | (1 << KP.RH)
+_BOTH_LINES = _LEFT_LINE | _RIGHT_LINE
+
+
+class FrameData:
+    """Pose detection information of a frame
+    to compare pose changes of subsequent frames against."""
+
+    __slots__ = [
+        "pose_dix",
+        "timestamp",
+        "thumbnail",
+        "left_angle_with_yaxis",
+        "right_angle_with_yaxis",
+        "body_vector_score",
+        "frame_hash",
+        "pose_mask",
+    ]
+
+    def __init__(
+        self,
+        pose_dix=None,
+        timestamp=None,
+        thumbnail=None,
+        left_angle_with_yaxis=None,
+        right_angle_with_yaxis=None,
+        body_vector_score=0,
+        frame_hash=None,
+        pose_mask=0,
+    ):
+        self.pose_dix = pose_dix
+        self.timestamp = timestamp
+        self.thumbnail = thumbnail
+        self.left_angle_with_yaxis = left_angle_with_yaxis
+        self.right_angle_with_yaxis = right_angle_with_yaxis
+        self.body_vector_score = body_vector_score
+        self.frame_hash = frame_hash
+        # bitmask of the detected keypoints in pose_dix, bit i for KP i
+        self.pose_mask = pose_mask
+
 
 class FallDetector(TFDetectionModel):
 
     """Detects falls comparing two images spaced about 1-2 seconds apart."""
 
-    def __init__(self, model=None, confidence_threshold=0.15, **kwargs):
+    def __init__(
+        self,
+        model=None,
+        confidence_threshold=0.15,
+        frame_change_threshold=0,
+        debug_dump_thumbnails=False,
+        batch_rotations=False,
+        **kwargs,
+    ):
         """Initialize detector with config parameters.
         :Parameters:
         ----------
@@ -27,6 +224,23 @@ class FallDetector(TFDetectionModel):
             'edgetpu':
                 'ai_models/posenet_mobilenet_v1_075_721_1281_quant_decoder_edgetpu.tflite'
         }
+        frame_change_threshold: int
+            Minimum number of differing bits b/w the 64 bit difference hashes
+            of a frame and the previous pose frame for the frame to be
+            considered a scene change. Frames below the threshold reuse the
+            previous pose without running pose detection.
+            0 (default) disables the check. The hash is coarse and may not
+            register small body movements, so only enable it for cameras
+            that watch mostly static scenes.
+        debug_dump_thumbnails: bool
+            Save thumbnails with the detected body lines drawn on them to the
+            data dir when logging at DEBUG level. Files are written
+            in the background and dropped when the writer falls behind.
+        batch_rotations: bool
+            When no upright pose is found, run pose detection on all rotated
+            views of the thumbnail in a single batched inference instead of
+            one rotation at a time. Only applies to the TFLite CPU runtime.
+            EdgeTPU models take one image per inference.
         """
         super().__init__(
             model=model, confidence_threshold=confidence_threshold, **kwargs
@@ -40,28 +254,12 @@ class FallDetector(TFDetectionModel):
 
         # previous pose detection information for frame at time t-1 and t-2 \
         # to compare pose changes against
-        self._prev_data = [None] * 2
-
-        # Data of previous frames lookup constants
-        self.POSE_VAL = "_prev_pose_dix"
-        self.TIMESTAMP = "_prev_time"
-        self.THUMBNAIL = "_prev_thumbnail"
-        self.LEFT_ANGLE_WITH_YAXIS = "_prev_left_angle_with_yaxis"
-        self.RIGHT_ANGLE_WITH_YAXIS = "_prev_right_angle_with_yaxis"
-        self.BODY_VECTOR_SCORE = "_prev_body_vector_score"
-
-        _dix = {
-            self.POSE_VAL: [],
-            self.TIMESTAMP: time.monotonic(),
-            self.THUMBNAIL: None,
-            self.LEFT_ANGLE_WITH_YAXIS: None,
-            self.RIGHT_ANGLE_WITH_YAXIS: None,
-            self.BODY_VECTOR_SCORE: 0,
-        }
-
         # self._prev_data[0] : store data of frame at t-2
         # self._prev_data[1] : store data of frame at t-1
-        self._prev_data[0] = self._prev_data[1] = _dix
+        now = time.monotonic()
+        self._prev_data = deque(
+            [FrameData(timestamp=now), FrameData(timestamp=now)], maxlen=2
+        )
 
         self._pose_engine = PoseEngine(self._tfengine, context=self.context)
         self._fall_factor = 60
@@ -81,6 +279,19 @@ class FallDetector(TFDetectionModel):
         # Otherwise there could be data noise which could lead
         # false positive detections.
         self.max_time_between_frames = 10
+        # Skip pose detection for frames that look the same as the previous
+        # pose frame.
+        self.frame_change_threshold = frame_change_threshold
+
+        # Debug thumbnails are JPEG encoded and saved off the detection
+        # thread. Up to _DEBUG_DUMP_QUEUE_SIZE saves can be pending at a time.
+        self._debug_dump_thumbnails = debug_dump_thumbnails
+        self._debug_dump_executor = None
+        self._debug_dump_slots = threading.BoundedSemaphore(_DEBUG_DUMP_QUEUE_SIZE)
+        if self._debug_dump_thumbnails:
+            self._debug_dump_executor = ThreadPoolExecutor(max_workers=1)
+
+        self._batch_rotations = batch_rotations
 
         # keypoint lookup constants
         self.LEFT_SHOULDER = "left shoulder"
@@ -88,6 +299,7 @@ class FallDetector(TFDetectionModel):
         self.RIGHT_SHOULDER = "right shoulder"
         self.RIGHT_HIP = "right hip"
 
+        # keypoint names in KP index order
         self.fall_detect_corr = [
             self.LEFT_SHOULDER,
             self.LEFT_HIP,
@@ -95,6 +307,9 @@ class FallDetector(TFDetectionModel):
             self.RIGHT_HIP,
         ]
 
+        # placeholder keypoints for frames without a detected pose
+        self._no_pose_dix = np.full((len(KP), 2), np.nan)
+
     def process_sample(self, **sample):
         """Detect objects in sample image."""
         log.debug("%s received new sample", self.__class__.__name__)
@@ -124,26 +339,6 @@ class FallDetector(TFDetectionModel):
                     str(sample),
                 )
 
-    def calculate_angle(self, p):
-        """
-        Calculate angle b/w two lines such as
-        left shoulder-hip with prev frame's left shoulder-hip or
-        right shoulder-hip with prev frame's right shoulder-hip or
-        shoulder-hip line with vertical axis
-        """
-
-        x1, y1 = p[0][0]
-        x2, y2 = p[0][1]
-
-        x3, y3 = p[1][0]
-        x4, y4 = p[1][1]
-
-        theta1 = math.degrees(math.atan2(y2 - y1, x1 - x2))
-        theta2 = math.degrees(math.atan2(y4 - y3, x3 - x4))
-
-        angle = abs(theta1 - theta2)
-        return angle
-
     def is_body_line_motion_downward(
         self, left_angle_with_yaxis, rigth_angle_with_yaxis, inx
     ):
@@ -152,14 +347,13 @@ class FallDetector(TFDetectionModel):
 
         l_angle = (
             left_angle_with_yaxis
-            and self._prev_data[inx][self.LEFT_ANGLE_WITH_YAXIS]
-            and left_angle_with_yaxis > self._prev_data[inx][self.LEFT_ANGLE_WITH_YAXIS]
+            and self._prev_data[inx].left_angle_with_yaxis
+            and left_angle_with_yaxis > self._prev_data[inx].left_angle_with_yaxis
         )
         r_angle = (
             rigth_angle_with_yaxis
-            and self._prev_data[inx][self.RIGHT_ANGLE_WITH_YAXIS]
-            and rigth_angle_with_yaxis
-            > self._prev_data[inx][self.RIGHT_ANGLE_WITH_YAXIS]
+            and self._prev_data[inx].right_angle_with_yaxis
+            and rigth_angle_with_yaxis > self._prev_data[inx].right_angle_with_yaxis
         )
 
         if l_angle or r_angle:
@@ -167,28 +361,66 @@ class FallDetector(TFDetectionModel):
 
         return test
 
+    def _rotated_poses(self, thumbnail, rotations):
+        """Yield (k, poses, scale) for the thumbnail rotated k times by 90'.
+        scale holds the (x, y) factors that map pose coordinates back
+        to the rotated thumbnail."""
+        # rotate the thumbnail rather than the full size image.
+        # a rotated view only fits a square model input as is,
+        # otherwise it is shrunk to fit.
+        thumbnail_array = np.asarray(thumbnail)
+        pose_engine = self._pose_engine
+        if self._batch_rotations:
+            views = [
+                pose_engine.fit_to_input_tensor(np.rot90(thumbnail_array, k))
+                for k in rotations
+            ]
+            results = pose_engine.detect_poses_in_arrays([a for a, _ in views])
+            for k, (poses, _), (_, scale) in zip(rotations, results, views):
+                yield k, poses, scale
+        else:
+            for k in rotations:
+                view, scale = pose_engine.fit_to_input_tensor(
+                    np.rot90(thumbnail_array, k)
+                )
+                poses, _ = pose_engine.detect_poses_in_array(view)
+                yield k, poses, scale
+
     def find_keypoints(self, image):
 
         # this score value should be related to the configuration \
         # confidence_threshold parameter
         min_score = self.confidence_threshold
-        rotations = [Image.ROTATE_270, Image.ROTATE_90]
-        angle = 0
+        # number of 90' counter clockwise rotations of the image to try
+        rotations = [1, 3]
+        k = 0
+        scale = (1.0, 1.0)
         pose = None
         poses, thumbnail, _ = self._pose_engine.detect_poses(image)
         width, height = thumbnail.size
+        if not poses:
+            return None, thumbnail, 0, None, 0
         # if no pose detected with high confidence,
         # try rotating the image +/- 90' to find a fallen person
         # currently only looking at pose[0] because we are focused \
-        # on a lone person falls
-        # while (not poses or poses[0].score < min_score) and rotations:
-        spinal_vector_score, pose_dix = self.estimate_spinal_vector_score(poses[0])
-        while spinal_vector_score < min_score and rotations:
-            angle = rotations.pop()
-            transposed = image.transpose(angle)
-            # we are interested in the poses but not the rotated thumbnail
-            poses, _, _ = self._pose_engine.detect_poses(transposed)
-            spinal_vector_score, pose_dix = self.estimate_spinal_vector_score(poses[0])
+        # on a lone person falls.
+        # The upright pose is the common case, so only pay for
+        # the extra rotated inferences when its score is too low.
+        spinal_vector_score, pose_dix, pose_mask = self.estimate_spinal_vector_score(
+            poses[0]
+        )
+        if spinal_vector_score < min_score:
+            for k, poses, scale in self._rotated_poses(thumbnail, rotations):
+                if poses:
+                    (
+                        spinal_vector_score,
+                        pose_dix,
+                        pose_mask,
+                    ) = self.estimate_spinal_vector_score(poses[0])
+                else:
+                    spinal_vector_score, pose_dix, pose_mask = 0, None, 0
+                if spinal_vector_score >= min_score:
+                    break
 
         if poses and poses[0]:
             pose = poses[0]
@@ -199,83 +431,64 @@ class FallDetector(TFDetectionModel):
             # if the image was rotated, we need to rotate back to the original\
             # image coordinates
             # before comparing with poses in other frames.
-            if angle == Image.ROTATE_90:
-                # ROTATE_90 rotates 90' counter clockwise \
-                # from ^ to < orientation.
-                for _, keypoint in pose.keypoints.items():
-                    # keypoint.yx[0] is the x coordinate in an image
-                    # keypoint.yx[0] is the y coordinate in an image, \
-                    # with 0,0 in the upper left corner (not lower left).
-                    tmp_swap = keypoint.yx[0]
-                    keypoint.yx[0] = width - keypoint.yx[1]
-                    keypoint.yx[1] = tmp_swap
-            elif angle == Image.ROTATE_270:
-                # ROTATE_270 rotates 90' clockwise from ^ to > orientation.
-                for _, keypoint in pose.keypoints.items():
-                    tmp_swap = keypoint.yx[0]
-                    keypoint.yx[0] = keypoint.yx[1]
-                    keypoint.yx[1] = height - tmp_swap
+            # keypoint.yx[0] is the x coordinate in an image
+            # keypoint.yx[1] is the y coordinate in an image, \
+            # with 0,0 in the upper left corner (not lower left).
+            if k:
+                rotation, offset = _inverse_rotation(k, width, height, scale)
+                keypoints = list(pose.keypoints.values())
+                kps = np.array([keypoint.yx for keypoint in keypoints])
+                for keypoint, yx in zip(keypoints, kps @ rotation.T + offset):
+                    keypoint.yx = list(yx)
+                pose_dix = pose_dix @ rotation.T + offset
             # we could not detexct a pose with sufficient confidence
             log.info(
-                f"""A pose detected with
-                    spinal_vector_score={spinal_vector_score} >= {min_score}
+                """A pose detected with
+                    spinal_vector_score=%s >= %s
                     confidence threshold.
-                    Pose keypoints: {pose_dix}"
-                """
+                    Pose keypoints: %r"
+                """,
+                spinal_vector_score,
+                min_score,
+                pose_dix,
             )
         else:
             pose = None
 
-        return pose, thumbnail, spinal_vector_score, pose_dix
-
-    def find_changes_in_angle(self, pose_dix, inx):
-        """
-        Find the changes in angle for shoulder-hip lines
-        b/w current and previpus frame.
-        """
-
-        prev_leftLine_corr_exist = all(
-            e in self._prev_data[inx][self.POSE_VAL]
-            for e in [self.LEFT_SHOULDER, self.LEFT_HIP]
-        )
-        curr_leftLine_corr_exist = all(
-            e in pose_dix for e in [self.LEFT_SHOULDER, self.LEFT_HIP]
-        )
+        return pose, thumbnail, spinal_vector_score, pose_dix, pose_mask
 
-        prev_rightLine_corr_exist = all(
-            e in self._prev_data[inx][self.POSE_VAL]
-            for e in [self.RIGHT_SHOULDER, self.RIGHT_HIP]
-        )
-        curr_rightLine_corr_exist = all(
-            e in pose_dix for e in [self.RIGHT_SHOULDER, self.RIGHT_HIP]
+    def is_recent_pose(self, prev_data, now):
+        """Check if a previous frame has a pose recent enough to compare to."""
+        return (
+            prev_data.pose_dix is not None
+            and now - prev_data.timestamp <= self.max_time_between_frames
         )
 
-        left_angle = right_angle = 0
-
-        if prev_leftLine_corr_exist and curr_leftLine_corr_exist:
-            temp_left_vector = [
-                [
-                    self._prev_data[inx][self.POSE_VAL][self.LEFT_SHOULDER],
-                    self._prev_data[inx][self.POSE_VAL][self.LEFT_HIP],
-                ],
-                [pose_dix[self.LEFT_SHOULDER], pose_dix[self.LEFT_HIP]],
-            ]
-            left_angle = self.calculate_angle(temp_left_vector)
-            log.debug("Left shoulder-hip angle: %r", left_angle)
-
-        if prev_rightLine_corr_exist and curr_rightLine_corr_exist:
-            temp_right_vector = [
-                [
-                    self._prev_data[inx][self.POSE_VAL][self.RIGHT_SHOULDER],
-                    self._prev_data[inx][self.POSE_VAL][self.RIGHT_HIP],
-                ],
-                [pose_dix[self.RIGHT_SHOULDER], pose_dix[self.RIGHT_HIP]],
-            ]
-            right_angle = self.calculate_angle(temp_right_vector)
-            log.debug("Right shoulder-hip angle: %r", right_angle)
-
-        angle_change = max(left_angle, right_angle)
-        return angle_change
+    def find_line_angles(self, pose_dix, pose_mask, now):
+        """
+        Find the angles of the current frame shoulder-hip lines
+        with the vertical axis and with the shoulder-hip lines
+        of the previous frames. Previous frames without a recent pose
+        are skipped.
+
+        :Returns:
+        -------
+        numpy.ndarray
+            Array of shape (3, 2). Row 0 holds the (left, right)
+            angles with the vertical axis. Rows 1 and 2 hold the
+            (left, right) changes in angle b/w the current frame and
+            the frames at t-1 and t-2 respectively.
+            Changes from skipped frames are 0.
+        """
+        # pass the previous frames as is rather than
+        # allocating arrays to hold them on every frame
+        args = [pose_dix, pose_mask]
+        for prev_data in reversed(self._prev_data):
+            if self.is_recent_pose(prev_data, now):
+                args += [prev_data.pose_dix, prev_data.pose_mask]
+            else:
+                args += [self._no_pose_dix, 0]
+        return _pose_geom(*args)
 
     def assign_prev_records(
         self,
@@ -285,198 +498,210 @@ class FallDetector(TFDetectionModel):
         now,
         thumbnail,
         current_body_vector_score,
+        frame_hash=None,
+        pose_mask=0,
     ):
 
-        curr_data = {
-            self.POSE_VAL: pose_dix,
-            self.TIMESTAMP: now,
-            self.THUMBNAIL: thumbnail,
-            self.LEFT_ANGLE_WITH_YAXIS: left_angle_with_yaxis,
-            self.RIGHT_ANGLE_WITH_YAXIS: rigth_angle_with_yaxis,
-            self.BODY_VECTOR_SCORE: current_body_vector_score,
-        }
-
-        self._prev_data[-2] = self._prev_data[-1]
-        self._prev_data[-1] = curr_data
+        # recycle the record of the frame at t-2 as the one at t-1
+        self._prev_data.rotate(-1)
+        curr_data = self._prev_data[1]
+        curr_data.pose_dix = pose_dix
+        curr_data.timestamp = now
+        curr_data.thumbnail = thumbnail
+        curr_data.left_angle_with_yaxis = left_angle_with_yaxis
+        curr_data.right_angle_with_yaxis = rigth_angle_with_yaxis
+        curr_data.body_vector_score = current_body_vector_score
+        curr_data.frame_hash = frame_hash
+        curr_data.pose_mask = pose_mask
+
+    def is_scene_unchanged(self, frame_hash, lapse):
+        """Check if a frame looks the same as the recent previous pose frame."""
+        prev_frame_hash = self._prev_data[1].frame_hash
+        return (
+            frame_hash is not None
+            and prev_frame_hash is not None
+            and self._prev_data[1].pose_dix is not None
+            and lapse < self.max_time_between_frames
+            and _hamming_distance(frame_hash, prev_frame_hash)
+            < self.frame_change_threshold
+        )
 
     def draw_lines(self, thumbnail, pose_dix, score):
         """Draw body lines if available. Return number of lines drawn."""
-        # save an image with drawn lines for debugging
-        draw = ImageDraw.Draw(thumbnail)
         body_lines_drawn = 0
 
         if pose_dix is None:
             return body_lines_drawn
 
-        if pose_dix.keys() >= {self.LEFT_SHOULDER, self.LEFT_HIP}:
-            body_line = [
-                tuple(pose_dix[self.LEFT_SHOULDER]),
-                tuple(pose_dix[self.LEFT_HIP]),
-            ]
-            draw.line(body_line, fill="red")
-            body_lines_drawn += 1
-
-        if pose_dix.keys() >= {self.RIGHT_SHOULDER, self.RIGHT_HIP}:
-            body_line = [
-                tuple(pose_dix[self.RIGHT_SHOULDER]),
-                tuple(pose_dix[self.RIGHT_HIP]),
-            ]
-            draw.line(body_line, fill="red")
-            body_lines_drawn += 1
+        # save an image with drawn lines for debugging
+        draw = ImageDraw.Draw(thumbnail)
+        for body_line in pose_dix.reshape(2, 2, 2):
+            if not np.isnan(body_line).any():
+                draw.line(
+                    [tuple(point) for point in body_line], fill=_LINE_COLOR, width=2
+                )
+                body_lines_drawn += 1
 
         # save a thumbnail for debugging
-        timestr = int(time.monotonic() * 1000)
-        debug_image_file_name = f"tmp-fall-detect-thumbnail-{timestr}-score-{score}.jpg"
-        thumbnail.save(Path(self._sys_data_dir, debug_image_file_name), format="JPEG")
+        if self._debug_dump_thumbnails:
+            timestr = int(time.monotonic() * 1000)
+            debug_image_file_name = (
+                f"tmp-fall-detect-thumbnail-{timestr}-score-{score}.jpg"
+            )
+            self._dump_debug_image(
+                thumbnail, Path(self._sys_data_dir, debug_image_file_name)
+            )
         return body_lines_drawn
 
-    def get_line_angles_with_yaxis(self, pose_dix):
-        """
-        Find the angle b/w shoulder-hip line with yaxis.
-        """
-        y_axis_corr = [[0, 0], [0, self._pose_engine._tensor_image_height]]
+    def _dump_debug_image(self, image, path):
+        """Save a copy of an image in the background. Drop it if too busy."""
+        if not self._debug_dump_slots.acquire(blocking=False):
+            log.debug("Too many pending debug images. Dropping %s", path)
+            return
 
-        leftLine_corr_exist = all(
-            e in pose_dix for e in [self.LEFT_SHOULDER, self.LEFT_HIP]
-        )
-        rightLine_corr_exist = all(
-            e in pose_dix for e in [self.RIGHT_SHOULDER, self.RIGHT_HIP]
-        )
+        def _on_saved(future):
+            self._debug_dump_slots.release()
+            if future.exception():
+                log.warning("Error saving debug image %s: %r", path, future.exception())
 
-        l_angle = r_angle = 0
+        future = self._debug_dump_executor.submit(_save_jpeg, image.copy(), path)
+        future.add_done_callback(_on_saved)
 
-        if leftLine_corr_exist:
-            l_angle = self.calculate_angle(
-                [y_axis_corr, [pose_dix[self.LEFT_SHOULDER], pose_dix[self.LEFT_HIP]]]
-            )
-
-        if rightLine_corr_exist:
-            r_angle = self.calculate_angle(
-                [y_axis_corr, [pose_dix[self.RIGHT_SHOULDER], pose_dix[self.RIGHT_HIP]]]
-            )
-
-        return (l_angle, r_angle)
+    def stop(self):
+        """Stop the element and wait for pending debug images to be saved."""
+        super().stop()
+        if self._debug_dump_executor:
+            self._debug_dump_executor.shutdown(wait=True)
+            self._debug_dump_executor = None
+            self._debug_dump_thumbnails = False
 
     def estimate_spinal_vector_score(self, pose):
-        pose_dix = {}
-        is_leftVector = is_rightVector = False
+        # keypoints indexed by KP,
+        # NaN coordinates mark keypoints below the confidence threshold
+        pose_dix = self._no_pose_dix.copy()
+        # bit i is set for each detected keypoint KP i
+        pose_mask = 0
+
+        # look up each fall detection keypoint once, in KP order
+        ls, lh, rs, rh = [pose.keypoints[name] for name in self.fall_detect_corr]
 
         # Calculate leftVectorScore & rightVectorScore
-        leftVectorScore = min(
-            pose.keypoints[self.LEFT_SHOULDER].score,
-            pose.keypoints[self.LEFT_HIP].score,
-        )
-        rightVectorScore = min(
-            pose.keypoints[self.RIGHT_SHOULDER].score,
-            pose.keypoints[self.RIGHT_HIP].score,
-        )
+        leftVectorScore = min(ls.score, lh.score)
+        rightVectorScore = min(rs.score, rh.score)
 
         if leftVectorScore > self.confidence_threshold:
-            is_leftVector = True
-            pose_dix[self.LEFT_SHOULDER] = pose.keypoints[self.LEFT_SHOULDER].yx
-            pose_dix[self.LEFT_HIP] = pose.keypoints[self.LEFT_HIP].yx
+            pose_mask |= _LEFT_LINE
+            pose_dix[KP.LS] = ls.yx
+            pose_dix[KP.LH] = lh.yx
 
         if rightVectorScore > self.confidence_threshold:
-            is_rightVector = True
-            pose_dix[self.RIGHT_SHOULDER] = pose.keypoints[self.RIGHT_SHOULDER].yx
-            pose_dix[self.RIGHT_HIP] = pose.keypoints[self.RIGHT_HIP].yx
+            pose_mask |= _RIGHT_LINE
+            pose_dix[KP.RS] = rs.yx
+            pose_dix[KP.RH] = rh.yx
 
         def find_spinalLine():
-            left_spinal_x1 = (
-                pose_dix[self.LEFT_SHOULDER][0] + pose_dix[self.RIGHT_SHOULDER][0]
-            ) / 2
-            left_spinal_y1 = (
-                pose_dix[self.LEFT_SHOULDER][1] + pose_dix[self.RIGHT_SHOULDER][1]
-            ) / 2
-
-            right_spinal_x1 = (
-                pose_dix[self.LEFT_HIP][0] + pose_dix[self.RIGHT_HIP][0]
-            ) / 2
-            right_spinal_y1 = (
-                pose_dix[self.LEFT_HIP][1] + pose_dix[self.RIGHT_HIP][1]
-            ) / 2
-
-            return (left_spinal_x1, left_spinal_y1), (right_spinal_x1, right_spinal_y1)
-
-        if is_leftVector and is_rightVector:
+            # mid points of the shoulders and of the hips
+            spinal_top, spinal_bottom = pose_dix.reshape(2, 2, 2).mean(axis=0)
+            return tuple(spinal_top), tuple(spinal_bottom)
+
+        if pose_mask == _BOTH_LINES:
             # spinalVectorEstimate = find_spinalLine()
             spinalVectorScore = (leftVectorScore + rightVectorScore) / 2.0
-        elif is_leftVector:
-            # spinalVectorEstimate = pose_dix[self.LEFT_SHOULDER], pose_dix[self.LEFT_HIP]
+        elif pose_mask == _LEFT_LINE:
+            # spinalVectorEstimate = pose_dix[KP.LS], pose_dix[KP.LH]
             # 10% score penalty in conficence as only \
             # left shoulder-hip line is detected
             spinalVectorScore = leftVectorScore * 0.9
-        elif is_rightVector:
-            # spinalVectorEstimate = (
-            #    pose_dix[self.RIGHT_SHOULDER],
-            #    pose_dix[self.RIGHT_HIP],
-            # )
+        elif pose_mask == _RIGHT_LINE:
+            # spinalVectorEstimate = pose_dix[KP.RS], pose_dix[KP.RH]
             # 10% score penalty in conficence as only \
             # right shoulder-hip line is detected
             spinalVectorScore = rightVectorScore * 0.9
         else:
             spinalVectorScore = 0
 
-        log.debug(f"Estimated spinal vector score: {spinalVectorScore}")
-        return spinalVectorScore, pose_dix
+        log.debug("Estimated spinal vector score: %s", spinalVectorScore)
+        return spinalVectorScore, pose_dix, pose_mask
 
     def fall_detect(self, image=None):
         assert image
         log.debug("Calling TF engine for inference")
         start_time = time.monotonic()
 
-        now = time.monotonic()
-        lapse = now - self._prev_data[-1][self.TIMESTAMP]
+        # read the detection settings once per frame
+        min_time_between_frames = self.min_time_between_frames
+        confidence_threshold = self.confidence_threshold
+        fall_factor = self._fall_factor
+
+        now = start_time
+        latest_data = self._prev_data[1]
+        lapse = now - latest_data.timestamp
 
-        if self._prev_data[-1][self.POSE_VAL] and lapse < self.min_time_between_frames:
+        too_soon = latest_data.pose_dix is not None and lapse < min_time_between_frames
+        frame_hash = None
+        if not too_soon and self.frame_change_threshold > 0:
+            frame_hash = _frame_hash(image)
+
+        if too_soon:
             log.debug(
                 "Received an image frame too soon after the previous \
                 frame. Only %.2f ms apart.\
                 Minimum %.2f ms period required for fall detection.",
                 lapse,
-                self.min_time_between_frames,
+                min_time_between_frames,
             )
             inference_result = None
-            thumbnail = self._prev_data[-1][self.THUMBNAIL]
+            thumbnail = latest_data.thumbnail
+        elif self.is_scene_unchanged(frame_hash, lapse):
+            log.debug(
+                "Image frame looks the same as the previous pose frame. \
+                Reusing the previous pose."
+            )
+            inference_result = None
+            thumbnail = latest_data.thumbnail
         else:
             # Detection using tensorflow posenet module
-            pose, thumbnail, spinal_vector_score, pose_dix = self.find_keypoints(image)
+            (
+                pose,
+                thumbnail,
+                spinal_vector_score,
+                pose_dix,
+                pose_mask,
+            ) = self.find_keypoints(image)
 
             inference_result = None
             if not pose:
                 log.debug(
-                    f"No pose detected or detection score does not meet \
-                    confidence threshold of {self.confidence_threshold}."
+                    "No pose detected or detection score does not meet \
+                    confidence threshold of %s.",
+                    confidence_threshold,
                 )
             else:
                 inference_result = []
 
                 current_body_vector_score = spinal_vector_score
 
-                # Find line angle with vertcal axis
-                (
-                    left_angle_with_yaxis,
-                    rigth_angle_with_yaxis,
-                ) = self.get_line_angles_with_yaxis(pose_dix)
+                # Find line angles with vertcal axis and
+                # changes in angle from previous frames in one go
+                line_angles = self.find_line_angles(pose_dix, pose_mask, now)
+                left_angle_with_yaxis, rigth_angle_with_yaxis = line_angles[0]
 
                 # save an image with drawn lines for debugging
                 if log.getEffectiveLevel() <= logging.DEBUG:
                     # development mode
                     self.draw_lines(thumbnail, pose_dix, spinal_vector_score)
 
-                for t in [-1, -2]:
-                    lapse = now - self._prev_data[t][self.TIMESTAMP]
+                # rows 1 and 2 hold the changes from frames t-1 and t-2
+                for inx, angle_changes in zip([1, 0], line_angles[1:]):
+                    prev_data = self._prev_data[inx]
 
-                    if (
-                        not self._prev_data[t][self.POSE_VAL]
-                        or lapse > self.max_time_between_frames
-                    ):
+                    if not self.is_recent_pose(prev_data, now):
                         log.debug(
                             "No recent pose to compare to. Will save \
                             this frame pose for subsequent comparison."
                         )
                     elif not self.is_body_line_motion_downward(
-                        left_angle_with_yaxis, rigth_angle_with_yaxis, inx=t
+                        left_angle_with_yaxis, rigth_angle_with_yaxis, inx=inx
                     ):
                         log.debug(
                             "The body-line angle with vertical axis is \
@@ -484,27 +709,23 @@ class FallDetector(TFDetectionModel):
                                     Not likely to be a fall."
                         )
                     else:
-                        leaning_angle = self.find_changes_in_angle(pose_dix, inx=t)
+                        leaning_angle = angle_changes.max()
+                        log.debug("Shoulder-hip angle changes: %r", angle_changes)
 
                         # Get leaning_probability by comparing leaning_angle
                         # with fall_factor probability.
-                        leaning_probability = (
-                            1 if leaning_angle > self._fall_factor else 0
-                        )
+                        leaning_probability = 1 if leaning_angle > fall_factor else 0
 
                         # Calculate fall score using average of current and \
                         # previous frame's body vector score with \
                         # leaning_probability
                         fall_score = (
                             leaning_probability
-                            * (
-                                self._prev_data[t][self.BODY_VECTOR_SCORE]
-                                + current_body_vector_score
-                            )
+                            * (prev_data.body_vector_score + current_body_vector_score)
                             / 2
                         )
 
-                        if fall_score >= self.confidence_threshold:
+                        if fall_score >= confidence_threshold:
                             inference_result.append(
                                 ("FALL", fall_score, leaning_angle, pose_dix)
                             )
@@ -512,10 +733,13 @@ class FallDetector(TFDetectionModel):
                             break
                         else:
                             log.debug(
-                                f"No fall detected due to low \
+                                "No fall detected due to low \
                             confidence score:  \
-                            {fall_score} < {self.confidence_threshold} \
-                            min threshold.Inference result: {inference_result}"
+                            %s < %s \
+                            min threshold.Inference result: %r",
+                                fall_score,
+                                confidence_threshold,
+                                inference_result,
                             )
 
                 log.debug("Saving pose for subsequent comparison.")
@@ -526,12 +750,15 @@ class FallDetector(TFDetectionModel):
                     now,
                     thumbnail,
                     current_body_vector_score,
+                    frame_hash,
+                    pose_mask,
                 )
 
                 # log.debug("Logging stats")
 
         self.log_stats(start_time=start_time)
-        log.debug("thumbnail: %r", thumbnail)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("thumbnail: %r", thumbnail)
         return inference_result, thumbnail
 
     def convert_inference_result(self, inference_result):
@@ -553,10 +780,8 @@ class FallDetector(TFDetectionModel):
                     "confidence": confidence,
                     "leaning_angle": leaning_angle,
                     "keypoint_corr": {
-                        "left shoulder": keypoint_corr.get("left shoulder", None),
-                        "left hip": keypoint_corr.get("left hip", None),
-                        "right shoulder": keypoint_corr.get("right shoulder", None),
-                        "right hip": keypoint_corr.get("right hip", None),
+                        name: None if np.isnan(corr).any() else corr.tolist()
+                        for name, corr in zip(self.fall_detect_corr, keypoint_corr)
                     },
                 }
                 inf_json.append(one_inf)
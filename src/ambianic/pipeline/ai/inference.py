@@ -98,6 +98,9 @@ class TFInferenceEngine:
         #                                      packaage=edgetpu_class)
         #        target_class = getattr(module_object, edgetpu_class)
         self._tf_interpreter = _get_edgetpu_interpreter(model=model_edgetpu)
+        self._is_edgetpu = self._tf_interpreter is not None
+        # CPU interpreters with batched input tensors, created on demand
+        self._tf_batch_interpreters = {}
         if not self._tf_interpreter:
             log.debug("EdgeTPU not available. Will use TFLite CPU runtime.")
             self._tf_interpreter = Interpreter(model_path=model_tflite)
@@ -120,6 +123,36 @@ class TFInferenceEngine:
     def is_quantized(self):
         return self._tf_is_quantized_model
 
+    @property
+    def is_edgetpu(self):
+        return self._is_edgetpu
+
+    def batch_interpreter(self, batch_size):
+        """Return a TFLite CPU interpreter that takes batch_size inputs at once.
+
+        Interpreters are created lazily and cached per batch size.
+
+        :Returns:
+        -------
+        Interpreter
+            An interpreter with input tensors resized to batch_size
+            or None when running on EdgeTPU. EdgeTPU models are compiled
+            for a fixed batch size of 1.
+
+        """
+        if self._is_edgetpu:
+            return None
+        interpreter = self._tf_batch_interpreters.get(batch_size)
+        if interpreter is None:
+            interpreter = Interpreter(model_path=self._model_tflite_path)
+            for input_detail in interpreter.get_input_details():
+                shape = list(input_detail["shape"])
+                shape[0] = batch_size
+                interpreter.resize_tensor_input(input_detail["index"], shape)
+            interpreter.allocate_tensors()
+            self._tf_batch_interpreters[batch_size] = interpreter
+        return interpreter
+
     @property
     def labels_path(self):
         """
@@ -5,7 +5,7 @@ from pathlib import Path
 import numpy as np
 from ambianic.configuration import DEFAULT_DATA_DIR
 from ambianic.pipeline.ai.tf_detect import TFDetectionModel
-from PIL import ImageDraw
+from PIL import Image, ImageDraw
 
 log = logging.getLogger(__name__)
 
@@ -76,6 +76,16 @@ class PoseEngine:
             self._tensor_image_depth,
         ) = self.get_input_tensor_shape()
 
+        # input tensor buffers reused by every single image inference.
+        # set_tensor copies the data, so they can be refilled right away.
+        self._floating_model = self._tfengine.input_details[0]["dtype"] == np.float32
+        self._template_input_buffer = np.zeros(self._input_tensor_shape, dtype=np.uint8)
+        self._input_tensor_buffer = None
+        if self._floating_model:
+            self._input_tensor_buffer = np.empty(
+                self._input_tensor_shape, dtype=np.float32
+            )
+
         self.confidence_threshold = self._tfengine.confidence_threshold
         log.debug(
             f"Initializing PoseEngine with confidence threshold \
@@ -155,21 +165,58 @@ class PoseEngine:
         thumbnail = TFDetectionModel.thumbnail(
             image=img, desired_size=_tensor_input_size
         )
-        # convert thumbnail into an image with the exact size
-        # as the input tensor preserving proportions by padding with
-        # a solid color as needed
-        template_image = TFDetectionModel.resize(
-            image=thumbnail, desired_size=_tensor_input_size
-        )
-
-        template_input = np.expand_dims(template_image.copy(), axis=0)
-        floating_model = self._tfengine.input_details[0]["dtype"] == np.float32
+        poses, pose_score = self.detect_poses_in_array(np.asarray(thumbnail))
+        return poses, thumbnail, pose_score
 
-        if floating_model:
-            template_input = (np.float32(template_input) - 127.5) / 127.5
+    def fit_to_input_tensor(self, img_array):
+        """
+        Shrinks an image array as needed to fit the AI model input tensor.
+        Preserves the aspect ratio of the image.
+        :Parameters:
+        ----------
+        img_array : numpy.ndarray
+            (height, width, channels) uint8 image array.
+        :Returns:
+        -------
+        numpy.ndarray
+            The image array as is if it fits the input tensor,
+            otherwise a resized copy that does.
+        (float, float)
+            The (x, y) factors that scale coordinates in the returned
+            image array back to coordinates in the given one.
+        """
+        height, width = img_array.shape[:2]
+        if width <= self._tensor_image_width and height <= self._tensor_image_height:
+            return img_array, (1.0, 1.0)
+        thumbnail = TFDetectionModel.thumbnail(
+            image=Image.fromarray(img_array),
+            desired_size=(self._tensor_image_width, self._tensor_image_height),
+        )
+        scale = (width / thumbnail.size[0], height / thumbnail.size[1])
+        return np.asarray(thumbnail), scale
 
+    def detect_poses_in_array(self, img_array):
+        """
+        Detects poses in an image array that fits the AI model input tensor.
+        :Parameters:
+        ----------
+        img_array : numpy.ndarray
+            (height, width, channels) uint8 image array no larger than
+            the input tensor, such as a thumbnail. Rotated views of a
+            thumbnail only fit square input tensors as is. Use
+            fit_to_input_tensor to shrink them for non-square ones.
+        :Returns:
+        -------
+        poses:
+            A list of Pose objects with keypoints and confidence scores
+        float
+            Overall pose score.
+        """
+        template_inputs = self._template_input_buffer
+        template_input = self._template_input(img_array, out=template_inputs[0])
         self.tf_interpreter().set_tensor(
-            self._tfengine.input_details[0]["index"], template_input
+            self._tfengine.input_details[0]["index"],
+            self._input_tensor(template_inputs, out=self._input_tensor_buffer),
         )
         self.tf_interpreter().invoke()
 
@@ -179,9 +226,77 @@ class PoseEngine:
         template_offset_data = self.tf_interpreter().get_tensor(
             self._tfengine.output_details[1]["index"]
         )
+        return self._decode_poses(
+            template_output_data[0], template_offset_data[0], template_input
+        )
+
+    def detect_poses_in_arrays(self, img_arrays):
+        """
+        Detects poses in several image arrays with a single batched inference.
+        Falls back to one inference per array when the model can't take
+        batched input, such as on EdgeTPU.
+        :Parameters:
+        ----------
+        img_arrays : list of numpy.ndarray
+            Image arrays as accepted by detect_poses_in_array.
+        :Returns:
+        -------
+        list
+            A (poses, pose_score) tuple for each image array, in order.
+        """
+        interpreter = None
+        if len(img_arrays) > 1:
+            interpreter = self._tfengine.batch_interpreter(len(img_arrays))
+        if interpreter is None:
+            return [self.detect_poses_in_array(a) for a in img_arrays]
+
+        template_inputs = np.empty(
+            (len(img_arrays),) + self._template_input_buffer.shape[1:], dtype=np.uint8
+        )
+        for img_array, template_input in zip(img_arrays, template_inputs):
+            self._template_input(img_array, out=template_input)
+        interpreter.set_tensor(
+            self._tfengine.input_details[0]["index"],
+            self._input_tensor(template_inputs),
+        )
+        interpreter.invoke()
+
+        template_output_data = interpreter.get_tensor(
+            self._tfengine.output_details[0]["index"]
+        )
+        template_offset_data = interpreter.get_tensor(
+            self._tfengine.output_details[1]["index"]
+        )
+        return [
+            self._decode_poses(heatmaps, offsets, template_input)
+            for heatmaps, offsets, template_input in zip(
+                template_output_data, template_offset_data, template_inputs
+            )
+        ]
 
-        template_heatmaps = np.squeeze(template_output_data)
-        template_offsets = np.squeeze(template_offset_data)
+    def _template_input(self, img_array, out):
+        # copy the image array into an array with the exact size
+        # as the input tensor preserving proportions by padding with
+        # a solid color as needed
+        height, width = img_array.shape[:2]
+        out[:height, :width] = img_array
+        out[height:] = 0
+        out[:height, width:] = 0
+        return out
+
+    def _input_tensor(self, template_inputs, out=None):
+        if self._floating_model:
+            out = np.subtract(
+                template_inputs, np.float32(127.5), out=out, dtype=np.float32
+            )
+            return np.divide(out, np.float32(127.5), out=out)
+        return template_inputs
+
+    def _decode_poses(self, template_heatmaps, template_offsets, template_input):
+        template_image = None
+        if log.getEffectiveLevel() <= logging.DEBUG:
+            # development mode
+            template_image = Image.fromarray(template_input)
 
         kps = self.parse_output(template_heatmaps, template_offsets, 0.3)
 
@@ -197,7 +312,7 @@ class PoseEngine:
 
             if prob > self.confidence_threshold:
                 cnt += 1
-                if log.getEffectiveLevel() <= logging.DEBUG:
+                if template_image is not None:
                     # development mode
                     # draw on image and save it for debugging
                     draw = ImageDraw.Draw(template_image)
@@ -209,9 +324,9 @@ class PoseEngine:
         # overall pose score is calculated as the average of all
         # individual keypoint scores
         pose_score = cnt / keypoint_count
-        log.debug(f"Overall pose score (keypoint score average): {pose_score}")
+        log.debug("Overall pose score (keypoint score average): %s", pose_score)
         poses.append(Pose(keypoint_dict, pose_score))
-        if cnt > 0 and log.getEffectiveLevel() <= logging.DEBUG:
+        if cnt > 0 and template_image is not None:
             # development mode
             # save template_image for debugging
             timestr = int(time.monotonic() * 1000)
@@ -227,4 +342,4 @@ class PoseEngine:
                 Path(self._sys_data_dir, debug_image_file_name), format="JPEG"
             )
             log.debug(f"Debug image saved: {debug_image_file_name}")
-        return poses, thumbnail, pose_score
+        return poses, pose_score
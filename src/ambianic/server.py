@@ -2,6 +2,7 @@
 import logging
 import logging.handlers
 import os
+import threading
 import time
 
 from ambianic import logger
@@ -42,6 +43,9 @@ class AmbianicServer:
         self._service_exit_requested = False
         self._service_restart_requested = False
         self._latest_heartbeat = time.monotonic()
+        self._latest_heartbeat_log = self._latest_heartbeat
+        # set to wake up the main thread loop when stop is requested
+        self._stop_event = threading.Event()
         self._config_observer = None
 
     def stop_watch_config(self):
@@ -99,8 +103,9 @@ class AmbianicServer:
     def _heartbeat(self):
         new_time = time.monotonic()
         # print a heartbeat message every so many seconds
-        if new_time - self._latest_heartbeat > MAIN_HEARTBEAT_LOG_INTERVAL:
+        if new_time - self._latest_heartbeat_log > MAIN_HEARTBEAT_LOG_INTERVAL:
             self._log_heartbeat()
+            self._latest_heartbeat_log = new_time
             # this is where hooks to external
             # monitoring services will come in
         self._latest_heartbeat = new_time
@@ -148,11 +153,14 @@ class AmbianicServer:
                 servers[s_name] = srv
 
             self._latest_heartbeat = time.monotonic()
+            self._latest_heartbeat_log = self._latest_heartbeat
 
             self._servers = servers
             # Keep the main thread running, otherwise signals are ignored.
+            # Check on the servers a few times per heartbeat log interval
+            # and wake up right away when stop is requested.
             while True:
-                time.sleep(0.5)
+                self._stop_event.wait(MAIN_HEARTBEAT_LOG_INTERVAL / 5)
                 self._healthcheck(servers)
                 self._heartbeat()
         except ServiceExit:
@@ -163,6 +171,7 @@ class AmbianicServer:
             self._stop_servers(servers)
             self._servers = {}
             self._service_exit_requested = False
+            self._stop_event.clear()
 
             # stop watching config  files
             self.stop_watch_config()
@@ -179,3 +188,4 @@ class AmbianicServer:
         """Programmatic stop of the main service."""
         log.info("Stopping server...")
         self._service_exit_requested = True
+        self._stop_event.set()
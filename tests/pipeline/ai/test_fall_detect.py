@@ -2,9 +2,16 @@
 import os
 import time
 
+import numpy as np
 from ambianic.pipeline import PipeElement
-from ambianic.pipeline.ai.fall_detect import FallDetector
+from ambianic.pipeline.ai.fall_detect import (
+    FallDetector,
+    _frame_hash,
+    _hamming_distance,
+    _inverse_rotation,
+)
 from ambianic.pipeline.ai.object_detect import ObjectDetector
+from ambianic.pipeline.ai.pose_engine import PoseEngine
 from PIL import Image
 
 
@@ -517,7 +524,7 @@ def test_draw_line_0():
     lines_drawn = fall_detector.draw_lines(image, pose_dix, 0.5)
     assert lines_drawn == 0
 
-    pose_dix = {}
+    pose_dix = np.full((4, 2), np.nan)
     lines_drawn = fall_detector.draw_lines(image, pose_dix, 0.5)
     assert lines_drawn == 0
 
@@ -529,7 +536,8 @@ def test_draw_line_1():
     fall_detector = FallDetector(**config)
 
     image = _get_image(file_name="fall_img_1.png")
-    pose_dix = {fall_detector.LEFT_SHOULDER: [0, 0], fall_detector.LEFT_HIP: [0, 1]}
+    # keypoints ordered as left shoulder, left hip, right shoulder, right hip
+    pose_dix = np.array([[0, 0], [0, 1], [np.nan, np.nan], [np.nan, np.nan]])
     lines_drawn = fall_detector.draw_lines(image, pose_dix, 0.5)
     assert lines_drawn == 1
 
@@ -541,7 +549,7 @@ def test_draw_line_1_1():
     fall_detector = FallDetector(**config)
 
     image = _get_image(file_name="fall_img_1.png")
-    pose_dix = {fall_detector.LEFT_SHOULDER: [0, 0]}
+    pose_dix = np.array([[0, 0], [np.nan, np.nan], [np.nan, np.nan], [np.nan, np.nan]])
     lines_drawn = fall_detector.draw_lines(image, pose_dix, 0.5)
     assert lines_drawn == 0
 
@@ -554,12 +562,7 @@ def test_draw_line_2():
 
     # The frame represents a person who is in a standing position.
     image = _get_image(file_name="fall_img_1.png")
-    pose_dix = {
-        fall_detector.LEFT_SHOULDER: [0, 0],
-        fall_detector.LEFT_HIP: [0, 1],
-        fall_detector.RIGHT_SHOULDER: [1, 0],
-        fall_detector.RIGHT_HIP: [1, 1],
-    }
+    pose_dix = np.array([[0, 0], [0, 1], [1, 0], [1, 1]])
     lines_drawn = fall_detector.draw_lines(image, pose_dix, 0.5)
     assert lines_drawn == 2
 
@@ -717,3 +720,220 @@ def test_fall_detection_2_frame_back_case_3():
     fall_detector.receive_next_sample(image=img_3)
 
     assert not result
+
+
+def test_find_keypoints_no_poses(mocker):
+    """Expect no pose and no error when the pose engine detects no poses."""
+    config = _fall_detect_config()
+    fall_detector = FallDetector(**config)
+
+    img = _get_image(file_name="fall_img_1.png")
+    thumbnail = img.copy()
+    detect_poses = mocker.patch.object(
+        fall_detector._pose_engine, "detect_poses", return_value=([], thumbnail, 0)
+    )
+    (
+        pose,
+        thumb,
+        spinal_vector_score,
+        pose_dix,
+        pose_mask,
+    ) = fall_detector.find_keypoints(img)
+
+    assert pose is None
+    assert thumb is thumbnail
+    assert spinal_vector_score == 0
+    assert pose_dix is None
+    assert pose_mask == 0
+    detect_poses.assert_called_once()
+
+
+def test_find_keypoints_upright_pose_single_inference(mocker):
+    """Expect no rotated image inference when the upright pose
+    meets the confidence threshold."""
+    config = _fall_detect_config()
+    fall_detector = FallDetector(**config)
+
+    # The frame represents a person who is in a standing position.
+    img = _get_image(file_name="fall_img_1.png")
+    detect_poses = mocker.spy(fall_detector._pose_engine, "detect_poses")
+    pose, _, spinal_vector_score, _, _ = fall_detector.find_keypoints(img)
+
+    assert pose
+    assert spinal_vector_score >= fall_detector.confidence_threshold
+    detect_poses.assert_called_once()
+
+
+def test_unchanged_scene_reuses_pose(mocker):
+    """Expect pose detection to be skipped for a frame that looks the same
+    as the previous pose frame when the frame change check is enabled."""
+    config = _fall_detect_config()
+    fall_detector = FallDetector(frame_change_threshold=5, **config)
+    fall_detector.min_time_between_frames = 0.01
+    detect_poses = mocker.spy(fall_detector._pose_engine, "detect_poses")
+
+    # The frame represents a person who is in a standing position.
+    img = _get_image(file_name="fall_img_1.png")
+    inference_result, thumbnail_1 = fall_detector.fall_detect(image=img)
+    assert inference_result == []
+    time.sleep(fall_detector.min_time_between_frames)
+    inference_result, thumbnail_2 = fall_detector.fall_detect(image=img)
+
+    assert inference_result is None
+    assert thumbnail_2 is thumbnail_1
+    detect_poses.assert_called_once()
+
+
+def test_frame_hash_full_hd_frame():
+    """Expect a full HD frame to hash like a smaller copy of it."""
+    img = _get_image(file_name="fall_img_1.png").convert("RGB")
+    full_hd_img = img.resize((1920, 1080), Image.BILINEAR)
+    assert _hamming_distance(_frame_hash(full_hd_img), _frame_hash(img)) <= 5
+
+
+def test_unchanged_scene_check_disabled_by_default(mocker):
+    """Expect pose detection for every frame by default."""
+    config = _fall_detect_config()
+    fall_detector = FallDetector(**config)
+    fall_detector.min_time_between_frames = 0.01
+    detect_poses = mocker.spy(fall_detector._pose_engine, "detect_poses")
+
+    # The frame represents a person who is in a standing position.
+    img = _get_image(file_name="fall_img_1.png")
+    fall_detector.fall_detect(image=img)
+    time.sleep(fall_detector.min_time_between_frames)
+    fall_detector.fall_detect(image=img)
+
+    assert detect_poses.call_count == 2
+
+
+def test_find_keypoints_batch_rotations(mocker):
+    """Expect the same rotated pose from a single batched inference
+    as from one inference per rotation."""
+    config = _fall_detect_config()
+    fall_detector = FallDetector(**config)
+    batch_fall_detector = FallDetector(batch_rotations=True, **config)
+    detect_poses_in_array = mocker.spy(
+        batch_fall_detector._pose_engine, "detect_poses_in_array"
+    )
+
+    # The frame represents a person completely falls.
+    img = _get_image(file_name="fall_img_12.png")
+    _, _, spinal_vector_score, pose_dix, _ = fall_detector.find_keypoints(img)
+    (
+        _,
+        _,
+        batch_spinal_vector_score,
+        batch_pose_dix,
+        _,
+    ) = batch_fall_detector.find_keypoints(img)
+
+    assert batch_spinal_vector_score >= batch_fall_detector.confidence_threshold
+    assert batch_spinal_vector_score == spinal_vector_score
+    assert np.array_equal(batch_pose_dix, pose_dix)
+    # the upright image is the only one inferred on its own
+    assert detect_poses_in_array.call_count == 1
+
+
+class _NonSquareTFEngine:
+    """Stand-in for a pose model with a non-square input tensor,
+    like the 721x1281 EdgeTPU PoseNet, that detects no confident
+    keypoints."""
+
+    def __init__(self, confidence_threshold=0.6):
+        self.confidence_threshold = confidence_threshold
+        self.input_details = [
+            {"index": 0, "shape": np.array([1, 145, 257, 3]), "dtype": np.uint8}
+        ]
+        self.output_details = [{"index": 1}, {"index": 2}]
+        self._tf_interpreter = self
+        self.input_shapes = []
+
+    def batch_interpreter(self, batch_size):
+        # no batched input, as on EdgeTPU
+        return None
+
+    def set_tensor(self, index, value):
+        self.input_shapes.append(value.shape)
+
+    def invoke(self):
+        pass
+
+    def get_tensor(self, index):
+        if index == 1:
+            # a single low scoring peak for each keypoint heatmap
+            heatmaps = np.full((1, 10, 17, 17), -10.0, dtype=np.float32)
+            heatmaps[0, 0, 0] = -5.0
+            return heatmaps
+        return np.zeros((1, 10, 17, 34), dtype=np.float32)
+
+
+def test_find_keypoints_non_square_model_input():
+    """Expect rotated thumbnails to be fit to a non-square model input."""
+    config = _fall_detect_config()
+    img = _get_image(file_name="fall_img_12.png")
+
+    for batch_rotations in [False, True]:
+        fall_detector = FallDetector(batch_rotations=batch_rotations, **config)
+        tfengine = _NonSquareTFEngine()
+        fall_detector._pose_engine = PoseEngine(tfengine)
+        pose, thumbnail, spinal_vector_score, _, _ = fall_detector.find_keypoints(img)
+
+        assert pose is None
+        assert spinal_vector_score < fall_detector.confidence_threshold
+        # the upright and both rotated views of the thumbnail were inferred
+        assert tfengine.input_shapes == [(1, 145, 257, 3)] * 3
+
+    # pose coordinates in a shrunk rotated view map back to the thumbnail
+    width, height = thumbnail.size
+    thumbnail_array = np.asarray(thumbnail)
+    xy = np.array([40.0, 100.0])
+    for k, rotated_xy in [(1, [xy[1], width - xy[0]]), (3, [height - xy[1], xy[0]])]:
+        view, scale = fall_detector._pose_engine.fit_to_input_tensor(
+            np.rot90(thumbnail_array, k)
+        )
+        assert view.shape[0] <= 145 and view.shape[1] <= 257
+        rotation, offset = _inverse_rotation(k, width, height, scale)
+        view_xy = np.array(rotated_xy) / scale
+        assert np.allclose(view_xy @ rotation.T + offset, xy)
+
+
+def test_prev_data_history():
+    """Expect separate records for the frames at t-2 and t-1,
+    with the oldest overwritten as new frames are recorded."""
+    config = _fall_detect_config()
+    fall_detector = FallDetector(**config)
+    assert fall_detector._prev_data[0] is not fall_detector._prev_data[1]
+    records = set(map(id, fall_detector._prev_data))
+
+    for now in [1, 2, 3]:
+        fall_detector.assign_prev_records(None, None, None, now, None, 0)
+
+    assert len(fall_detector._prev_data) == 2
+    # records are updated in place rather than replaced
+    assert set(map(id, fall_detector._prev_data)) == records
+    assert fall_detector._prev_data[0].timestamp == 2
+    assert fall_detector._prev_data[1].timestamp == 3
+
+
+def test_find_line_angles_skips_stale_poses():
+    """Expect no angle changes from previous poses that are too old
+    to compare to."""
+    config = _fall_detect_config()
+    fall_detector = FallDetector(**config)
+    pose_dix = np.array([[0.0, 0.0], [0.0, 10.0], [5.0, 0.0], [5.0, 10.0]])
+    fallen_pose_dix = np.array([[0.0, 0.0], [10.0, 0.0], [0.0, 5.0], [10.0, 5.0]])
+    pose_mask = 0b1111
+    fall_detector.assign_prev_records(fallen_pose_dix, 0, 0, 0, None, 1, None, 0b1111)
+    fall_detector.assign_prev_records(fallen_pose_dix, 0, 0, 1, None, 1, None, 0b1111)
+
+    now = 1 + fall_detector.max_time_between_frames / 2
+    line_angles = fall_detector.find_line_angles(pose_dix, pose_mask, now)
+    assert np.allclose(line_angles[1], [90, 90])
+    assert np.allclose(line_angles[2], [90, 90])
+
+    now = 0.5 + fall_detector.max_time_between_frames
+    line_angles = fall_detector.find_line_angles(pose_dix, pose_mask, now)
+    assert np.allclose(line_angles[0], [0, 0])
+    assert np.allclose(line_angles[1], [90, 90])
+    assert np.allclose(line_angles[2], [0, 0])
@@ -62,11 +62,13 @@ def _helper_test_debug_image_save(context: PipelineContext = None):
             image is not None and thumbnail is not None and inference_result is not None
         )
 
-    fall_detector = FallDetector(context=context, **config)
+    fall_detector = FallDetector(context=context, debug_dump_thumbnails=True, **config)
     output = _OutPipeElement(sample_callback=sample_callback)
     fall_detector.connect_to_next_element(output)
     img_1 = _get_image(file_name="fall_img_1.png")
     fall_detector.receive_next_sample(image=img_1)
+    # wait for the background debug image saves to complete
+    fall_detector.stop()
     assert result is True
     # now that we know there was a positive detection
     # lets check if the the interim debug images were saved as expected
@@ -96,3 +98,26 @@ def test_debug_image_save_with_context():
     context = PipelineContext()
     context.data_dir = DEFAULT_DATA_DIR
     _helper_test_debug_image_save(context)
+
+
+def test_debug_thumbnail_save_disabled_by_default():
+    """In DEBUG mode Fall detection should not save fall detection
+    thumbnails unless explicitly enabled."""
+    log_config = DynaBox({"level": "DEBUG"})
+    logger.configure(config=log_config)
+
+    config = _fall_detect_config()
+    fall_detector = FallDetector(**config)
+    img_1 = _get_image(file_name="fall_img_1.png")
+    inference_result, thumbnail = fall_detector.fall_detect(image=img_1)
+    fall_detector.stop()
+    assert inference_result is not None
+    assert thumbnail is not None
+    fall_img_files = list(_data_dir.glob("tmp-fall-detect-thumbnail*.jpg"))
+    assert not fall_img_files
+    # cleanup after test
+    for f in _data_dir.glob("tmp-pose-detect-image*.jpg"):
+        f.unlink()
+    # return logger level to INFO to prevent side effects in other tests
+    log_config = {"level": "INFO"}
+    logger.configure(config=log_config)
@@ -97,9 +97,9 @@ def test_resize():
     img_path = os.path.join(_dir, "background.jpg")
     image = Image.open(img_path)
     orig_width = image.size[0]
-    assert orig_width == 1280
+    assert orig_width == 640
     orig_height = image.size[1]
-    assert orig_height == 720
+    assert orig_height == 360
     new_size = (300, 300)
     new_image = TFDetectionModel.resize(image=image, desired_size=new_size)
     new_width = new_image.size[0]
@@ -113,9 +113,9 @@ def test_thumbnail():
     img_path = os.path.join(_dir, "background.jpg")
     image = Image.open(img_path)
     orig_width = image.size[0]
-    assert orig_width == 1280
+    assert orig_width == 640
     orig_height = image.size[1]
-    assert orig_height == 720
+    assert orig_height == 360
     new_size = (300, 300)
     new_image = TFDetectionModel.thumbnail(image=image, desired_size=new_size)
     new_width = new_image.size[0]
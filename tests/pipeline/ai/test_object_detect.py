@@ -1,25 +1,50 @@
 """Test object detection pipe element."""
+import functools
 import os
+from pathlib import Path
 
+import pytest
 from ambianic.pipeline import PipeElement
 from ambianic.pipeline.ai.object_detect import ObjectDetector
 from PIL import Image
+from tflite_runtime.interpreter import load_delegate
+
+_TEST_DIR = Path(__file__).resolve().parent
+
+# (width, height) of the object detection model input tensor
+_MODEL_INPUT_SIZE = (300, 300)
+
+
+def _edgetpu_available():
+    """Probe once for an EdgeTPU so detectors in this module don't retry it.
+
+    Set AMBIANIC_TEST_DISABLE_EDGETPU=1 to always run the CPU model.
+    """
+    if os.environ.get("AMBIANIC_TEST_DISABLE_EDGETPU", "") not in ("", "0"):
+        return False
+    try:
+        load_delegate("libedgetpu.so.1.0")
+    except Exception:
+        return False
+    return True
+
+
+_HAS_EDGETPU = _edgetpu_available()
 
 
 def _object_detect_config():
-    _dir = os.path.dirname(os.path.abspath(__file__))
-    _good_tflite_model = os.path.join(
-        _dir, "mobilenet_ssd_v2_coco_quant_postprocess.tflite"
+    _good_tflite_model = str(
+        _TEST_DIR / "mobilenet_ssd_v2_coco_quant_postprocess.tflite"
     )
-    _good_edgetpu_model = os.path.join(
-        _dir, "mobilenet_ssd_v2_coco_quant_postprocess_edgetpu.tflite"
+    _good_edgetpu_model = str(
+        _TEST_DIR / "mobilenet_ssd_v2_coco_quant_postprocess_edgetpu.tflite"
     )
-    _good_labels = os.path.join(_dir, "coco_labels.txt")
+    _good_labels = str(_TEST_DIR / "coco_labels.txt")
+    model = {"tflite": _good_tflite_model}
+    if _HAS_EDGETPU:
+        model["edgetpu"] = _good_edgetpu_model
     config = {
-        "model": {
-            "tflite": _good_tflite_model,
-            "edgetpu": _good_edgetpu_model,
-        },
+        "model": model,
         "labels": _good_labels,
         "top_k": 3,
         "confidence_threshold": 0.8,
@@ -27,14 +52,43 @@ def _object_detect_config():
     return config
 
 
+@functools.lru_cache(maxsize=None)
 def _get_image(file_name=None):
+    """Return a decoded test image already fit to the model input size.
+
+    Images are cached and shared by tests, which must not modify them.
+    """
     assert file_name
-    _dir = os.path.dirname(os.path.abspath(__file__))
-    image_file = os.path.join(_dir, file_name)
-    img = Image.open(image_file)
+    img = Image.open(_TEST_DIR / file_name)
+    # decode now and close the file
+    img.load()
+    # shrink once the same way the detector does, preserving aspect ratio,
+    # so the detector's own thumbnail step has nothing left to resize
+    img.thumbnail(_MODEL_INPUT_SIZE)
     return img
 
 
+@pytest.fixture(scope="module")
+def _module_detector():
+    """Object detector shared by the tests in this module
+    so the model is loaded only once."""
+    config = _object_detect_config()
+    detector = ObjectDetector(**config)
+    # the first inference is much slower than the rest while the interpreter
+    # prepares the model weights. run it on a blank image before the tests.
+    detector.detect(image=Image.new("RGB", _MODEL_INPUT_SIZE))
+    return detector
+
+
+@pytest.fixture
+def detector(_module_detector):
+    """Shared object detector reset to the default test config."""
+    config = _object_detect_config()
+    _module_detector._tfengine._confidence_threshold = config["confidence_threshold"]
+    _module_detector._label_filter = config.get("label_filter")
+    return _module_detector
+
+
 class _OutPipeElement(PipeElement):
     def __init__(self, sample_callback=None):
         super().__init__()
@@ -45,343 +99,132 @@ class _OutPipeElement(PipeElement):
         self._sample_callback(**sample)
 
 
-def test_model_inputs():
-    """Verify against known model inputs."""
-    config = _object_detect_config()
-    object_detector = ObjectDetector(**config)
-    tfe = object_detector._tfengine
-    samples = tfe.input_details[0]["shape"][0]
-    assert samples == 1
-    height = tfe.input_details[0]["shape"][1]
-    assert height == 300
-    width = tfe.input_details[0]["shape"][2]
-    assert width == 300
-    colors = tfe.input_details[0]["shape"][3]
-    assert colors == 3
-
-
-def test_model_outputs():
-    """Verify against known model outputs."""
-    config = _object_detect_config()
-    object_detector = ObjectDetector(**config)
-    tfe = object_detector._tfengine
-    assert tfe.output_details[0]["shape"][0] == 1
-    scores = tfe.output_details[0]["shape"][1]
-    assert scores == 20
-    assert tfe.output_details[1]["shape"][0] == 1
-    boxes = tfe.output_details[1]["shape"][1]
-    assert boxes == 20
-    assert tfe.output_details[2]["shape"][0] == 1
-    labels = tfe.output_details[2]["shape"][1]
-    assert labels == 20
-    num = tfe.output_details[3]["shape"][0]
-    assert num == 1
-
-
-def test_background_image():
-    """Expect to not detect anything interesting in a background image."""
-    config = _object_detect_config()
-    result = None
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    img = _get_image(file_name="background.jpg")
-    object_detector.receive_next_sample(image=img)
-    assert not result
-
-
-def test_one_person():
-    """Expect to detect one person."""
-    config = _object_detect_config()
-    result = None
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    img = _get_image(file_name="person.jpg")
-    object_detector.receive_next_sample(image=img)
+class _Sink:
+    """Sample callback that keeps the latest sample passed to it."""
+
+    def __init__(self, result=None):
+        self.image = None
+        self.result = result
+        self.called = False
+
+    def __call__(self, image=None, inference_result=None, **kwargs):
+        self.image = image
+        self.result = inference_result
+        self.called = True
+
+
+def _assert_detection(result, i, label, min_confidence):
+    """Expect the i-th detection to be a label with a valid box."""
+    detection = result[i]
+    assert detection["label"] == label
+    assert detection["confidence"] > min_confidence
+    box = detection["box"]
+    assert 0 < box["xmin"] < box["xmax"]
+    assert 0 < box["ymin"] < box["ymax"]
+
+
+def test_model_io(detector):
+    """Verify against known model inputs and outputs."""
+    tfe = detector._tfengine
+    width, height = _MODEL_INPUT_SIZE
+    assert tfe.input_details[0]["shape"].tolist() == [1, height, width, 3]
+    # boxes, labels and scores for the top 20 detections
+    # followed by the number of detections
+    output_shapes = [d["shape"].tolist()[:2] for d in tfe.output_details]
+    assert output_shapes == [[1, 20], [1, 20], [1, 20], [1]]
+
+
+@pytest.mark.parametrize(
+    "file_name,confidence_threshold,label_filter,expected",
+    [
+        # nothing interesting in a background image
+        pytest.param("background.jpg", 0.8, None, [], id="background_image"),
+        pytest.param("person.jpg", 0.8, None, [("person", 0.9)], id="one_person"),
+        pytest.param(
+            "person_thermal_bw.jpg",
+            0.8,
+            None,
+            [("person", 0.8)],
+            id="one_person_thermal",
+        ),
+        pytest.param(
+            "person-no-face.jpg", 0.8, None, [("person", 0.9)], id="one_person_no_face"
+        ),
+        # one person and no other objects
+        pytest.param(
+            "person-couch.jpg",
+            0.7,
+            ["person"],
+            [("person", 0.7)],
+            id="one_label_filter",
+        ),
+        pytest.param(
+            "person-couch.jpg",
+            0.6,
+            ["person", "couch"],
+            [("person", 0.7), ("couch", 0.6)],
+            id="two_labels_filter",
+        ),
+        # no label filter detects all labeled objects
+        pytest.param(
+            "person-couch.jpg",
+            0.6,
+            None,
+            [("person", 0.7), ("couch", 0.6)],
+            id="no_labels_filter",
+        ),
+        # the label is not in the training label set
+        pytest.param(
+            "person-couch.jpg", 0.6, ["SomeR@ndomJunk"], [], id="bad_label_filter"
+        ),
+        # no object with the given label in the picture
+        pytest.param(
+            "person-couch.jpg", 0.6, ["car"], [], id="one_label_not_in_picture"
+        ),
+    ],
+)
+def test_detect(detector, file_name, confidence_threshold, label_filter, expected):
+    """Expect to detect the (label, min confidence) objects in an image."""
+    detector._tfengine._confidence_threshold = confidence_threshold
+    detector._label_filter = label_filter
+    sink = _Sink()
+    output = _OutPipeElement(sample_callback=sink)
+    detector.connect_to_next_element(output)
+    img = _get_image(file_name=file_name)
+    detector.receive_next_sample(image=img)
+    result = sink.result
+    if not expected:
+        assert not result
+        return
     assert result
-    assert len(result) == 1
-
-    category = result[0]["label"]
-    confidence = result[0]["confidence"]
-    (x0, y0) = result[0]["box"]["xmin"], result[0]["box"]["ymin"]
-    (x1, y1) = result[0]["box"]["xmax"], result[0]["box"]["ymax"]
-
-    assert category == "person"
-    assert confidence > 0.9
-    assert x0 > 0 and x0 < x1
-    assert y0 > 0 and y0 < y1
-
-
-def test_one_person_thermal():
-    """Expect to detect one person."""
-    config = _object_detect_config()
-    result = None
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    img = _get_image(file_name="person_thermal_bw.jpg")
-    object_detector.receive_next_sample(image=img)
-    assert result
-    assert len(result) == 1
-
-    category = result[0]["label"]
-    confidence = result[0]["confidence"]
-    (x0, y0) = result[0]["box"]["xmin"], result[0]["box"]["ymin"]
-    (x1, y1) = result[0]["box"]["xmax"], result[0]["box"]["ymax"]
+    assert len(result) == len(expected)
 
-    assert category == "person"
-    assert confidence > 0.8
-    assert x0 > 0 and x0 < x1
-    assert y0 > 0 and y0 < y1
+    for i, (label, min_confidence) in enumerate(expected):
+        _assert_detection(result, i, label, min_confidence)
 
 
-def test_no_sample():
+def test_no_sample(detector):
     """Expect element to pass empty sample to next element."""
-    config = _object_detect_config()
-    result = "Something"
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-        result = image is None and inference_result is None
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    object_detector.receive_next_sample()
-    assert result is True
+    sink = _Sink(result="Something")
+    output = _OutPipeElement(sample_callback=sink)
+    detector.connect_to_next_element(output)
+    detector.receive_next_sample()
+    assert sink.called
+    assert sink.image is None and sink.result is None
 
 
-def test_bad_sample_good_sample():
+def test_bad_sample_good_sample(detector):
     """One bad sample should not prevent good samples from being processed."""
-    config = _object_detect_config()
-    result = "nothing passed to me"
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
+    sink = _Sink(result="nothing passed to me")
+    output = _OutPipeElement(sample_callback=sink)
+    detector.connect_to_next_element(output)
     # bad sample
-    object_detector.receive_next_sample(image=None)
-    assert result == "nothing passed to me"
+    detector.receive_next_sample(image=None)
+    assert sink.result == "nothing passed to me"
     # good sample
     img = _get_image(file_name="person.jpg")
-    object_detector.receive_next_sample(image=img)
-    assert result
-    assert len(result) == 1
-
-    category = result[0]["label"]
-    confidence = result[0]["confidence"]
-    (x0, y0) = result[0]["box"]["xmin"], result[0]["box"]["ymin"]
-    (x1, y1) = result[0]["box"]["xmax"], result[0]["box"]["ymax"]
-
-    assert category == "person"
-    assert confidence > 0.9
-    assert x0 > 0 and x0 < x1
-    assert y0 > 0 and y0 < y1
-
-
-def test_one_person_no_face():
-    """Expect to detect one person."""
-    config = _object_detect_config()
-    result = None
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    img = _get_image(file_name="person-no-face.jpg")
-    object_detector.receive_next_sample(image=img)
+    detector.receive_next_sample(image=img)
+    result = sink.result
     assert result
     assert len(result) == 1
-
-    category = result[0]["label"]
-    confidence = result[0]["confidence"]
-    (x0, y0) = result[0]["box"]["xmin"], result[0]["box"]["ymin"]
-    (x1, y1) = result[0]["box"]["xmax"], result[0]["box"]["ymax"]
-
-    assert category == "person"
-    assert confidence > 0.9
-    assert x0 > 0 and x0 < x1
-    assert y0 > 0 and y0 < y1
-
-
-def test_one_label_filter():
-    """Expect to detect one person and no other objects."""
-    config = _object_detect_config()
-    confidence_threshold = 0.7
-    config["confidence_threshold"] = confidence_threshold
-    config["label_filter"] = ["person"]
-    result = None
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    img = _get_image(file_name="person-couch.jpg")
-    object_detector.receive_next_sample(image=img)
-    assert result
-    assert len(result) == 1
-
-    category = result[0]["label"]
-    confidence = result[0]["confidence"]
-    (x0, y0) = result[0]["box"]["xmin"], result[0]["box"]["ymin"]
-    (x1, y1) = result[0]["box"]["xmax"], result[0]["box"]["ymax"]
-
-    assert category == "person"
-    assert confidence > confidence_threshold
-    assert x0 > 0 and x0 < x1
-    assert y0 > 0 and y0 < y1
-
-
-def test_two_labels_filter():
-    """Expect to detect one person and one couch."""
-    config = _object_detect_config()
-    config["confidence_threshold"] = 0.6
-    config["label_filter"] = ["person", "couch"]
-    result = None
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    img = _get_image(file_name="person-couch.jpg")
-    object_detector.receive_next_sample(image=img)
-    assert result
-    assert len(result) == 2
-
-    category = result[0]["label"]
-    confidence = result[0]["confidence"]
-    (x0, y0) = result[0]["box"]["xmin"], result[0]["box"]["ymin"]
-    (x1, y1) = result[0]["box"]["xmax"], result[0]["box"]["ymax"]
-
-    assert category == "person"
-    assert confidence > 0.7
-    assert x0 > 0 and x0 < x1
-    assert y0 > 0 and y0 < y1
-
-    category = result[1]["label"]
-    confidence = result[1]["confidence"]
-    (x0, y0) = result[1]["box"]["xmin"], result[1]["box"]["ymin"]
-    (x1, y1) = result[1]["box"]["xmax"], result[1]["box"]["ymax"]
-
-    assert category == "couch"
-    assert confidence > 0.6
-    assert x0 > 0 and x0 < x1
-    assert y0 > 0 and y0 < y1
-
-
-def test_no_labels_filter():
-    """Expect to detect all labeled objects - one person and one couch."""
-    config = _object_detect_config()
-    config["confidence_threshold"] = 0.6
-    # No label_filter set, which is the same as None
-    # config['label_filter'] = None
-    result = None
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    img = _get_image(file_name="person-couch.jpg")
-    object_detector.receive_next_sample(image=img)
-    assert result
-    assert len(result) == 2
-
-    category = result[0]["label"]
-    confidence = result[0]["confidence"]
-    (x0, y0) = result[0]["box"]["xmin"], result[0]["box"]["ymin"]
-    (x1, y1) = result[0]["box"]["xmax"], result[0]["box"]["ymax"]
-
-    assert category == "person"
-    assert confidence > 0.7
-    assert x0 > 0 and x0 < x1
-    assert y0 > 0 and y0 < y1
-
-    category = result[1]["label"]
-    confidence = result[1]["confidence"]
-    (x0, y0) = result[1]["box"]["xmin"], result[1]["box"]["ymin"]
-    (x1, y1) = result[1]["box"]["xmax"], result[1]["box"]["ymax"]
-
-    assert category == "couch"
-    assert confidence > 0.6
-    assert x0 > 0 and x0 < x1
-    assert y0 > 0 and y0 < y1
-
-
-def test_bad_label_filter():
-    """Expect to detect nothing because the label is not in the training
-    label set."""
-    config = _object_detect_config()
-    config["confidence_threshold"] = 0.6
-    config["label_filter"] = ["SomeR@ndomJunk"]
-    result = None
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    img = _get_image(file_name="person-couch.jpg")
-    object_detector.receive_next_sample(image=img)
-    assert not result
-
-
-def test_one_label_not_in_picture():
-    """Expect to detect nothing because there is no object with the given
-    label in the picture."""
-    config = _object_detect_config()
-    config["confidence_threshold"] = 0.6
-    config["label_filter"] = ["car"]
-    result = None
-
-    def sample_callback(image=None, inference_result=None, **kwargs):
-        nonlocal result
-
-        result = inference_result
-
-    object_detector = ObjectDetector(**config)
-    output = _OutPipeElement(sample_callback=sample_callback)
-    object_detector.connect_to_next_element(output)
-    img = _get_image(file_name="person-couch.jpg")
-    object_detector.receive_next_sample(image=img)
-    assert not result
+    _assert_detection(result, 0, "person", 0.9)
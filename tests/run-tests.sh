@@ -17,6 +17,7 @@ set -ex
 pip3 install -U pytest # unit test tool
 pip3 install -U codecov # code coverage tool
 pip3 install -U pytest-cov # coverage plugin for pytest
+pip3 install -U pytest-xdist # parallel test runs plugin for pytest
 pip3 install -U pylint # python linter
 BASEDIR=$(dirname $0)
 pip3 install -e $BASEDIR/../src
@@ -26,7 +27,9 @@ echo "Script location: ${BASEDIR}"
 cd $BASEDIR/../
 echo PWD=$PWD
 COV_MIN_THRESHOLD=94
-python3 -m pytest -v --log-cli-level=DEBUG --cov=ambianic -c "dev/dev-config.yaml" --cov-report=xml --cov-report=term --cov-fail-under=$COV_MIN_THRESHOLD tests/
+# run test files in parallel, keeping the tests of each file in one worker
+# so they share module scoped fixtures and don't race on the same test data
+python3 -m pytest -n auto --dist=loadfile -v --log-cli-level=DEBUG --cov=ambianic -c "dev/dev-config.yaml" --cov-report=xml --cov-report=term --cov-fail-under=$COV_MIN_THRESHOLD tests/
 
 # if -u command line argument is passed, submit code coverage report to codecov.io
 # parse command line arguments